@@ -1,73 +1,92 @@
 import asyncio
+import contextlib
+import math
 import os
-import json
-from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
-from typing import Dict, Any, Optional
+import signal
+import time
+from decimal import Decimal
+from typing import Dict, Any, List, Optional, Tuple
 
 import httpx
+import orjson
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from telegram.ext import AIORateLimiter, ApplicationBuilder, ContextTypes, MessageHandler, filters
+
+try:
+    import msgpack  # optional: only needed when STATE_PATH ends in .msgpack
+except ImportError:
+    msgpack = None
 
 # --- config/env ---
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "").strip()
 DEX_API = "https://api.dexscreener.com/latest/dex/tokens/{contract}"
+DEX_BATCH = 30  # Dexscreener accepts up to 30 comma-joined addresses per call
+FETCH_CONCURRENCY = 8  # max in-flight Dexscreener requests
+DEX_RPM = float(os.environ.get("DEX_RPM", "60") or 60)  # Dexscreener request ceiling per minute (default 1 req/s)
 POLL_SECONDS = 5 * 60  # 5 minutes
+PRICE_TTL = POLL_SECONDS // 2  # seconds a cached pair is fresh enough for price checks
+META_TTL = 60 * 60  # seconds a cached pair is fresh enough for names/urls
+CONDITIONAL_CACHE_MAX = 256  # chunk URLs whose ETag/Last-Modified we remember
+SHUTDOWN_TIMEOUT = 10  # seconds to let background tasks wind down
+SEND_CONCURRENCY = 25  # max chats being sent to at once (pacing is AIORateLimiter's job)
+SEND_RETRIES = 1  # resend once after a Telegram RetryAfter instead of dropping the alert
 STATE_PATH = os.environ.get("STATE_PATH", "/app/watchlist.json")  # where we save/load watchlist
-
-HEADERS = {"User-Agent": "fib75-telegram-bot/1.5"}
+PERSIST_SECONDS = 2  # debounce window for state writes
+PERSIST_MAX_BACKOFF = 5 * 60  # cap on the retry delay after failed writes
+
+HEADERS = {
+    "User-Agent": "fib75-telegram-bot/1.5",
+    "Accept": "application/json",
+    "Accept-Encoding": "gzip, br",  # batched responses are large; br needs the brotli extra
+}
+HTTP: Optional[httpx.AsyncClient] = None  # shared keep-alive client, created in main()
 chat_state: Dict[int, Dict[str, Dict[str, Any]]] = {}  # per-chat in-memory
+_pair_cache: Dict[str, Tuple[float, Optional[Dict[str, Any]]]] = {}  # contract -> (fetched_at, top pair)
+_pair_inflight: Dict[str, "asyncio.Future"] = {}  # contract -> pending fetch, so concurrent callers share it
+_conditional_cache: Dict[str, Tuple[Optional[str], Optional[str], Dict[str, Any]]] = {}  # url -> (etag, last_modified, top pairs)
+_state_dirty = asyncio.Event()  # set by save_state(), cleared by flush_state()
 
-def d(x, q=8):
-    if not isinstance(x, Decimal):
-        x = Decimal(str(x))
-    return x.quantize(Decimal(10) ** -q, rounding=ROUND_HALF_UP)
+# Decimal constants, parsed once instead of on every call
+_Q4 = Decimal("0.0001")
+_Q7 = Decimal("0.0000001")
 
-def compute_fib75(L: Decimal, H: Decimal) -> Decimal:
-    return L + Decimal("0.25") * (H - L)
+# Band math runs on floats: USD prices vs a ±2% band need nowhere near
+# Decimal precision. Decimal is only used to quantize for display (fmt_usd).
+def compute_fib75(L: float, H: float) -> float:
+    return L + 0.25 * (H - L)
 
-def band_bounds(fib75: Decimal):
-    return (fib75 * Decimal("0.98"), fib75 * Decimal("1.02"))
+def band_bounds(fib75: float) -> Tuple[float, float]:
+    return (fib75 * 0.98, fib75 * 1.02)
 
-def within_band(price: Decimal, lo: Decimal, hi: Decimal) -> bool:
+def within_band(price: float, lo: float, hi: float) -> bool:
     return lo <= price <= hi
 
 def ensure_chat(chat_id: int):
     if chat_id not in chat_state:
         chat_state[chat_id] = {}
 
-def fmt_usd(x: Decimal) -> str:
-    if x >= Decimal("1"):
-        return f"{x.quantize(Decimal('0.0001'))} USD"
-    else:
-        return f"{x.quantize(Decimal('0.0000001'))} USD"
+def fmt_usd(x: float) -> str:
+    # pick the quantum with a float compare; build the one Decimal only to round
+    return f"{Decimal(repr(x)).quantize(_Q4 if x >= 1 else _Q7)} USD"
 
 def build_pair_url(pair: Dict[str, Any]) -> str:
     return pair.get("url") or "https://dexscreener.com/solana"
 
-# ---------- persistence helpers ----------
-def _state_to_jsonable(state: Dict[int, Dict[str, Dict[str, Any]]]) -> Dict[str, Any]:
-    """Convert Decimals/tuples to JSON-friendly forms."""
-    out: Dict[str, Any] = {}
-    for chat_id, contracts in state.items():
-        chat_key = str(chat_id)
-        out[chat_key] = {}
-        for contract, st in contracts.items():
-            out_st = dict(st)
-            # convert Decimals to strings
-            for key in ["L", "H", "fib75"]:
-                if key in out_st and isinstance(out_st[key], Decimal):
-                    out_st[key] = str(out_st[key])
-            if "band" in out_st:
-                lo, hi = out_st["band"]
-                out_st["band"] = [str(lo), str(hi)]
-            if "last_price" in out_st and isinstance(out_st["last_price"], Decimal):
-                out_st["last_price"] = str(out_st["last_price"])
-            out[chat_key][contract] = out_st
-    return out
+def pair_summary(pair: Dict[str, Any]) -> Dict[str, Any]:
+    """The slice of a Dexscreener pair we keep in state as st["pair"]."""
+    base = pair.get("baseToken") or {}
+    quote = pair.get("quoteToken") or {}
+    return {
+        "url": build_pair_url(pair),
+        "dex": pair.get("dexId"),
+        "base": base.get("symbol") or base.get("name") or "Token",
+        "quote": quote.get("symbol") or quote.get("name") or "",
+    }
 
+# ---------- persistence helpers ----------
 def _jsonable_to_state(data: Dict[str, Any]) -> Dict[int, Dict[str, Dict[str, Any]]]:
-    """Convert strings back to Decimals/tuples."""
+    """Convert lists back to tuples; numbers saved as strings (older files) to floats."""
     restored: Dict[int, Dict[str, Dict[str, Any]]] = {}
     for chat_key, contracts in (data or {}).items():
         try:
@@ -78,16 +97,16 @@ def _jsonable_to_state(data: Dict[str, Any]) -> Dict[int, Dict[str, Dict[str, An
         for contract, st in contracts.items():
             st2 = dict(st)
             for key in ["L", "H", "fib75"]:
-                if key in st2 and isinstance(st2[key], str):
-                    try: st2[key] = Decimal(st2[key])
-                    except Exception: st2[key] = Decimal("0")
+                if key in st2:
+                    try: st2[key] = float(st2[key])
+                    except Exception: st2[key] = 0.0
             if "band" in st2 and isinstance(st2["band"], list) and len(st2["band"]) == 2:
                 try:
-                    st2["band"] = (Decimal(st2["band"][0]), Decimal(st2["band"][1]))
+                    st2["band"] = (float(st2["band"][0]), float(st2["band"][1]))
                 except Exception:
-                    st2["band"] = (Decimal("0"), Decimal("0"))
-            if "last_price" in st2 and isinstance(st2["last_price"], str):
-                try: st2["last_price"] = Decimal(st2["last_price"])
+                    st2["band"] = (0.0, 0.0)
+            if st2.get("last_price") is not None:
+                try: st2["last_price"] = float(st2["last_price"])
                 except Exception: st2["last_price"] = None
             # sanity defaults
             st2.setdefault("status", "outside")
@@ -98,16 +117,63 @@ def _jsonable_to_state(data: Dict[str, Any]) -> Dict[int, Dict[str, Dict[str, An
             restored[chat_id][contract] = st2
     return restored
 
+def _use_msgpack() -> bool:
+    if not STATE_PATH.endswith(".msgpack"):
+        return False
+    if msgpack is None:
+        raise RuntimeError("STATE_PATH ends in .msgpack but msgpack is not installed")
+    return True
+
+def _encode_state(state: Dict[int, Dict[str, Dict[str, Any]]]) -> bytes:
+    # every stored value is JSON/msgpack-native (tuples go out as arrays), so the
+    # live state is encoded directly; int chat ids become object keys on the way
+    if _use_msgpack():
+        return msgpack.packb(state, default=str)
+    return orjson.dumps(state, option=orjson.OPT_NON_STR_KEYS, default=str)
+
+def _decode_state(raw: bytes) -> Dict[Any, Any]:
+    if _use_msgpack():
+        return msgpack.unpackb(raw, strict_map_key=False)
+    return orjson.loads(raw)
+
 def save_state():
+    """Mark state dirty; persist_loop writes it out (debounced, off the event loop)."""
+    _state_dirty.set()
+
+def _write_state_sync(payload: bytes):
+    tmp = STATE_PATH + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+    os.replace(tmp, STATE_PATH)  # atomic on POSIX
+
+async def flush_state() -> bool:
+    """Write state if dirty. Returns False if the write failed (state stays dirty)."""
+    if not _state_dirty.is_set():
+        return True
+    _state_dirty.clear()
     try:
-        data = _state_to_jsonable(chat_state)
-        tmp = STATE_PATH + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
-        os.replace(tmp, STATE_PATH)  # atomic on POSIX
+        # snapshot on the loop thread, write in a worker thread
+        payload = _encode_state(chat_state)
+        await asyncio.to_thread(_write_state_sync, payload)
         print(f"[STATE] saved to {STATE_PATH}")
+        return True
     except Exception as e:
+        _state_dirty.set()  # still unsaved; persist_loop retries with backoff
         print(f"[STATE] save error: {e}")
+        return False
+
+async def persist_loop():
+    delay = PERSIST_SECONDS
+    try:
+        while True:
+            await _state_dirty.wait()
+            await asyncio.sleep(delay)  # let a burst of changes land in one write
+            if await flush_state():
+                delay = PERSIST_SECONDS
+            else:
+                delay = min(delay * 2, PERSIST_MAX_BACKOFF)  # don't hammer a broken disk/path
+    finally:
+        await flush_state()  # don't drop the last debounce window on shutdown
 
 def load_state():
     global chat_state
@@ -115,48 +181,179 @@ def load_state():
         if not os.path.exists(STATE_PATH):
             print(f"[STATE] no existing state at {STATE_PATH}")
             return
-        with open(STATE_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(STATE_PATH, "rb") as f:
+            data = _decode_state(f.read())
         chat_state = _jsonable_to_state(data)
         print(f"[STATE] loaded from {STATE_PATH}")
     except Exception as e:
         print(f"[STATE] load error: {e}")
 
 # --------- API helpers ----------
-async def fetch_top_pair(contract: str) -> Optional[Dict[str, Any]]:
-    url = DEX_API.format(contract=contract)
-    try:
-        async with httpx.AsyncClient(timeout=10, headers=HEADERS) as client:
-            r = await client.get(url)
-            r.raise_for_status()
-            data = r.json()
-    except Exception as e:
-        print(f"[ERR] fetch_top_pair({contract}): {e}")
-        return None
-
-    pairs = data.get("pairs") or []
-    best = None
+async def _bounded(sem: asyncio.Semaphore, coro):
+    async with sem:
+        return await coro
+
+async def gather_bounded(limit: int, coros: List[Any]) -> List[Any]:
+    """asyncio.gather with at most `limit` coroutines running; exceptions are returned, not raised."""
+    sem = asyncio.Semaphore(limit)
+    return await asyncio.gather(*(_bounded(sem, c) for c in coros), return_exceptions=True)
+
+class TokenBucket:
+    """Async token bucket: refills `rate` tokens/sec up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+                self.last_update = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def stall(self, seconds: float):
+        """Hold back all callers for `seconds` (e.g. a 429 Retry-After)."""
+        self.tokens = 0
+        self.last_update = max(self.last_update, time.monotonic()) + seconds
+
+DEX_BUCKET = TokenBucket(rate=max(DEX_RPM, 1) / 60, capacity=FETCH_CONCURRENCY)
+
+def pick_top_pair(pairs: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # one pass, one lookup per field; the score is a ranking key only (no money
+    # math), so plain floats are enough
+    best_key, best_p = None, None
     for p in pairs:
+        if p.get("chainId") != "solana":  # Dexscreener always sends it lowercase
+            continue
+        vol_d = p.get("volume")
+        liq_d = p.get("liquidity")
         try:
-            if p.get("chainId") != "solana":
-                continue
-            vol = Decimal(str(((p.get("volume") or {}).get("h24")) or 0))
-            liq = Decimal(str(((p.get("liquidity") or {}).get("usd")) or 0))
-            score = (vol, liq)
-            if best is None or score > best[0]:
-                best = (score, p)
-        except Exception:
+            v = float(vol_d.get("h24") or 0) if vol_d else 0.0
+            l = float(liq_d.get("usd") or 0) if liq_d else 0.0
+        except (AttributeError, TypeError, ValueError):
+            continue
+        k = (v, l)
+        if best_key is None or k > best_key:
+            best_key, best_p = k, p
+    return best_p
+
+async def fetch_top_pairs_chunk(chunk: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+    """One Dexscreener call for up to DEX_BATCH contracts -> top pair per contract.
+    Conditional GET: when the response carried an ETag/Last-Modified, the next call
+    sends it back and a 304 reuses the previous result without parsing anything."""
+    url = DEX_API.format(contract=",".join(chunk))
+    headers = {}
+    prev = _conditional_cache.get(url)
+    if prev:
+        etag, last_modified, _ = prev
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    await DEX_BUCKET.acquire()
+    r = await HTTP.get(url, headers=headers)
+    if r.status_code == 304 and prev:
+        return prev[2]
+    if r.status_code == 429:
+        try:
+            retry_after = float(r.headers.get("retry-after") or 60)
+        except ValueError:
+            retry_after = 60.0
+        print(f"[WARN] Dexscreener 429, backing off {retry_after:.0f}s")
+        DEX_BUCKET.stall(retry_after)
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    by_addr: Dict[str, List[Dict[str, Any]]] = {}
+    for p in data.get("pairs") or []:
+        addr = (p.get("baseToken") or {}).get("address")
+        if addr:
+            by_addr.setdefault(addr, []).append(p)
+    result = {contract: pick_top_pair(by_addr.get(contract, [])) for contract in chunk}
+
+    etag, last_modified = r.headers.get("etag"), r.headers.get("last-modified")
+    _conditional_cache.pop(url, None)
+    if etag or last_modified:
+        _conditional_cache[url] = (etag, last_modified, result)
+        while len(_conditional_cache) > CONDITIONAL_CACHE_MAX:
+            del _conditional_cache[next(iter(_conditional_cache))]  # oldest first
+    return result
+
+async def _fetch_top_pairs_uncached(contracts: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+    chunks = [contracts[i:i + DEX_BATCH] for i in range(0, len(contracts), DEX_BATCH)]
+    results = await gather_bounded(FETCH_CONCURRENCY, [fetch_top_pairs_chunk(c) for c in chunks])
+
+    out: Dict[str, Optional[Dict[str, Any]]] = {}
+    for chunk, res in zip(chunks, results):
+        if isinstance(res, Exception):
+            print(f"[ERR] fetch_top_pairs({','.join(chunk)}): {res}")
             continue
-    return best[1] if best else None
+        out.update(res)
+    return out
+
+async def fetch_top_pairs(contracts: List[str], max_age: float = PRICE_TTL) -> Dict[str, Optional[Dict[str, Any]]]:
+    """Top pair per contract, served from cache when younger than max_age.
+    Contracts whose chunk failed to fetch are left out."""
+    now = time.monotonic()
+    out: Dict[str, Optional[Dict[str, Any]]] = {}
+    pending: Dict[str, "asyncio.Future"] = {}
+    miss: List[str] = []
+    for contract in dict.fromkeys(contracts):
+        hit = _pair_cache.get(contract)
+        # a "no Solana pair" answer may just mean not indexed yet: only trust it briefly
+        if hit and now - hit[0] < (max_age if hit[1] is not None else min(max_age, PRICE_TTL)):
+            out[contract] = hit[1]
+        elif contract in _pair_inflight:
+            pending[contract] = _pair_inflight[contract]
+        else:
+            miss.append(contract)
+
+    if miss:
+        fut = asyncio.get_running_loop().create_future()
+        for contract in miss:
+            _pair_inflight[contract] = fut
+        fetched: Dict[str, Optional[Dict[str, Any]]] = {}
+        try:
+            fetched = await _fetch_top_pairs_uncached(miss)
+        finally:
+            for contract in miss:
+                _pair_inflight.pop(contract, None)
+            if not fut.done():
+                fut.set_result(fetched)
+        now = time.monotonic()
+        for contract, pair in fetched.items():
+            _pair_cache[contract] = (now, pair)
+        for contract, (ts, _) in list(_pair_cache.items()):
+            if now - ts > META_TTL:
+                del _pair_cache[contract]
+        out.update(fetched)
+
+    for contract, fut in pending.items():
+        res = await asyncio.shield(fut)
+        if contract in res:
+            out[contract] = res[contract]
+    return out
+
+async def fetch_top_pair(contract: str, max_age: float = PRICE_TTL) -> Optional[Dict[str, Any]]:
+    return (await fetch_top_pairs([contract], max_age)).get(contract)
 
-async def get_price_usd_from_pair(pair: Dict[str, Any]) -> Optional[Decimal]:
+def get_price_usd_from_pair(pair: Dict[str, Any]) -> Optional[float]:
+    # priceUsd is a decimal string; float() parses it directly, no Decimal involved
+    price_str = pair.get("priceUsd")
+    if price_str is None:
+        return None
     try:
-        price_str = pair.get("priceUsd")
-        if price_str is None:
-            return None
-        return Decimal(str(price_str))
-    except (InvalidOperation, TypeError):
+        price = float(price_str)
+    except (TypeError, ValueError):
         return None
+    return price if math.isfinite(price) else None
 
 # --------- Commands ---------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -189,31 +386,33 @@ async def add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     ensure_chat(chat_id)
 
-    raw = (update.message.text or "")
-    parts = raw.split()
+    # maxsplit: the trailing name stays one string, no split-then-join
+    parts = (update.message.text or "").split(maxsplit=4)
     if len(parts) < 4:
         return await update.message.reply_text("Usage: /add <contract> <low_usd> <high_usd> [name]")
 
     contract, Ls, Hs = parts[1], parts[2], parts[3]
-    name_given = " ".join(parts[4:]).strip() if len(parts) > 4 else ""
+    name_given = parts[4].strip() if len(parts) > 4 else ""
 
     try:
-        L = Decimal(Ls)
-        H = Decimal(Hs)
+        L = float(Ls)
+        H = float(Hs)
+        if not (math.isfinite(L) and math.isfinite(H)):
+            raise ValueError("non-finite bound")
         if not (L < H):
             return await update.message.reply_text("Low must be < High. Try again.")
-    except InvalidOperation:
+    except ValueError:
         return await update.message.reply_text("Low/High must be numbers in USD. Try again.")
 
     fib75 = compute_fib75(L, H)
     lo, hi = band_bounds(fib75)
 
-    pair = await fetch_top_pair(contract)
+    pair = await fetch_top_pair(contract, max_age=META_TTL)
     if not pair:
         return await update.message.reply_text("Could not find a valid Solana pair for that contract (24h volume/liquidity required).")
 
-    base_sym = (pair.get("baseToken") or {}).get("symbol") or (pair.get("baseToken") or {}).get("name") or "Token"
-    quote_sym = (pair.get("quoteToken") or {}).get("symbol") or (pair.get("quoteToken") or {}).get("name") or ""
+    summary = pair_summary(pair)
+    base_sym, quote_sym = summary["base"], summary["quote"]
     auto_name = f"{base_sym}/{quote_sym}" if base_sym and quote_sym else base_sym
     display_name = name_given if name_given else auto_name
 
@@ -225,7 +424,7 @@ async def add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "status": "outside",
         "first_tick": True,
         "alerts_sent": 0,
-        "pair": {},
+        "pair": summary,  # seeded from this fetch so /list needn't refetch
         "last_price": None
     }
 
@@ -242,7 +441,7 @@ async def add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def remove_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     ensure_chat(chat_id)
-    parts = (update.message.text or "").split()
+    parts = (update.message.text or "").split(maxsplit=2)
     if len(parts) != 2:
         return await update.message.reply_text("Usage: /remove <contract>")
     contract = parts[1]
@@ -269,15 +468,10 @@ async def list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Try to use the saved Dexscreener URL; if missing, fetch once.
         pair_url = (st.get("pair") or {}).get("url")
         if not pair_url:
-            p = await fetch_top_pair(contract)
+            p = await fetch_top_pair(contract, max_age=META_TTL)
             if p:
-                pair_url = build_pair_url(p)
-                st["pair"] = {
-                    "url": pair_url,
-                    "dex": p.get("dexId"),
-                    "base": (p.get("baseToken") or {}).get("symbol") or (p.get("baseToken") or {}).get("name") or "Token",
-                    "quote": (p.get("quoteToken") or {}).get("symbol") or (p.get("quoteToken") or {}).get("name") or "",
-                }
+                st["pair"] = pair_summary(p)
+                pair_url = st["pair"]["url"]
 
         entry = (
             f"{name}\n"
@@ -295,98 +489,216 @@ async def clear_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     save_state()
     await update.message.reply_text("Cleared all tracked contracts for this chat.")
 
+# command name -> handler; one MessageHandler routes all of them (see dispatch)
+COMMANDS = {
+    "start": start,
+    "help": help_cmd,
+    "version": version_cmd,
+    "ping": ping_cmd,
+    "add": add_cmd,
+    "remove": remove_cmd,
+    "list": list_cmd,
+    "clear": clear_cmd,
+}
+
+async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    head = (update.message.text or "").split(maxsplit=1)[0]
+    cmd, _, target = head[1:].partition("@")
+    if target and target.lower() != (context.bot.username or "").lower():
+        return  # /cmd@OtherBot in a group
+    fn = COMMANDS.get(cmd.lower())
+    if fn:
+        await fn(update, context)
+    elif target or update.effective_chat.type == "private":
+        # in groups, stay quiet about bare /cmds that may belong to another bot
+        await update.message.reply_text(f"Unknown command /{cmd}. Try /help.")
+
 # -------- background price loop --------
-async def poll_job(context_like):
+async def _send_chat_alerts(bot, chat_id: int, msgs: List[str]):
+    # one chat's alerts go out one after another, so they arrive in order
+    for msg in msgs:
+        try:
+            await bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.MARKDOWN)
+        except Exception as e:
+            print(f"[ERR] send_message(chat={chat_id}): {e}")
+
+async def send_alerts(bot, outbox):
+    # different chats are sent to concurrently (at most SEND_CONCURRENCY at once);
+    # the bot's AIORateLimiter paces the actual msg/s and retries on RetryAfter
+    by_chat: Dict[int, List[str]] = {}
+    for chat_id, msg in outbox:
+        by_chat.setdefault(chat_id, []).append(msg)
+    await gather_bounded(SEND_CONCURRENCY, [_send_chat_alerts(bot, c, m) for c, m in by_chat.items()])
+
+def _process_tick(st: Dict[str, Any], price: float, summary: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
+    """Apply one fetched price to one watcher's state. Returns (changed, alert message or None)."""
     changed = False
-    for chat_id, contracts in list(chat_state.items()):
-        to_remove = []
-        for contract, st in list(contracts.items()):
+    msg = None
+    st["pair"] = summary
+    if not st.get("name"):
+        base_sym, quote_sym = summary["base"], summary["quote"]
+        st["name"] = f"{base_sym}/{quote_sym}" if base_sym and quote_sym else base_sym
+        changed = True
+    lo, hi = st["band"]
+    inside = within_band(price, lo, hi)
+    if inside and (st["status"] == "outside" or st["first_tick"]):
+        st["alerts_sent"] += 1; changed = True
+        st["status"] = "inside"; st["first_tick"] = False
+        if st["alerts_sent"] <= 2:
+            msg = (
+                "🚨 *75% Fib Retracement Alert!* 🚨\n"
+                f"*Watch:* {st['name']}\n"
+                f"*Token:* {st['pair']['base']}\n"
+                f"*Level Hit:* {fmt_usd(st['fib75'])}\n"
+                f"*Band:* [{fmt_usd(lo)} — {fmt_usd(hi)}]\n"
+                f"*Price Now:* {fmt_usd(price)}\n"
+                f"*Pair:* {st['pair']['dex']} / {st['pair']['quote']}\n"
+                f"[Dexscreener]({st['pair']['url']})\n"
+                f"_Alerts sent for this contract:_ {st['alerts_sent']}/2"
+            )
+    else:
+        new_status = "inside" if inside else "outside"
+        if new_status != st["status"]:
+            st["status"] = new_status; changed = True
+    st["last_price"] = price
+    return changed, msg
+
+async def poll_job(bot):
+    changed = False
+    to_remove = []
+    outbox = []  # (chat_id, msg) alerts, sent together at the end of the tick
+    # group watchers by contract so each contract is fetched/parsed once per tick,
+    # however many chats track it (bands stay per chat)
+    by_contract: Dict[str, List[Tuple[int, Dict[str, Any]]]] = {}
+    # no await and no removals inside this loop, so iterate the live dicts
+    for chat_id, contracts in chat_state.items():
+        for contract, st in contracts.items():
             if st["alerts_sent"] >= 2:
-                to_remove.append(contract); changed = True; continue
-            pair = await fetch_top_pair(contract)
-            if not pair:
-                continue
-            price = await get_price_usd_from_pair(pair)
-            if price is None:
-                continue
-            base_sym = (pair.get("baseToken") or {}).get("symbol") or (pair.get("baseToken") or {}).get("name") or "Token"
-            quote_sym = (pair.get("quoteToken") or {}).get("symbol") or (pair.get("quoteToken") or {}).get("name") or ""
-            st["pair"] = {"url": build_pair_url(pair), "dex": pair.get("dexId"), "base": base_sym, "quote": quote_sym}
-            if not st.get("name"):
-                st["name"] = f"{base_sym}/{quote_sym}" if base_sym and quote_sym else base_sym
-                changed = True
-            lo, hi = st["band"]
-            inside = within_band(price, lo, hi)
-            if inside and (st["status"] == "outside" or st["first_tick"]):
-                st["alerts_sent"] += 1; changed = True
-                st["status"] = "inside"; st["first_tick"] = False
-                if st["alerts_sent"] <= 2:
-                    msg = (
-                        "🚨 *75% Fib Retracement Alert!* 🚨\n"
-                        f"*Watch:* {st['name']}\n"
-                        f"*Token:* {st['pair']['base']}\n"
-                        f"*Level Hit:* {fmt_usd(st['fib75'])}\n"
-                        f"*Band:* [{fmt_usd(lo)} — {fmt_usd(hi)}]\n"
-                        f"*Price Now:* {fmt_usd(price)}\n"
-                        f"*Pair:* {st['pair']['dex']} / {st['pair']['quote']}\n"
-                        f"[Dexscreener]({st['pair']['url']})\n"
-                        f"_Alerts sent for this contract:_ {st['alerts_sent']}/2"
-                    )
-                    try:
-                        await context_like.bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.MARKDOWN)
-                    except Exception as e:
-                        print(f"[ERR] send_message: {e}")
-                if st["alerts_sent"] >= 2:
-                    to_remove.append(contract)
-            else:
-                new_status = "inside" if inside else "outside"
-                if new_status != st["status"]:
-                    st["status"] = new_status; changed = True
-            st["last_price"] = price
-        for c in to_remove:
-            contracts.pop(c, None)
+                to_remove.append((chat_id, contract)); changed = True; continue
+            by_contract.setdefault(contract, []).append((chat_id, st))
+
+    # batched + concurrent fetch, then mutate state serially below
+    pairs = await fetch_top_pairs(list(by_contract))
+
+    for contract, watchers in by_contract.items():
+        pair = pairs.get(contract)
+        if not pair:
+            continue
+        price = get_price_usd_from_pair(pair)
+        if price is None:
+            continue
+        summary = pair_summary(pair)
+        for chat_id, st in watchers:
+            if chat_state.get(chat_id, {}).get(contract) is not st:
+                continue  # removed/replaced by a command while we were fetching
+            st_changed, msg = _process_tick(st, price, summary)
+            changed = changed or st_changed
+            if msg:
+                outbox.append((chat_id, msg))
+            if st["alerts_sent"] >= 2:
+                to_remove.append((chat_id, contract))
+    for chat_id, c in to_remove:
+        chat_state.get(chat_id, {}).pop(c, None)
     if changed:
         save_state()
+    await send_alerts(bot, outbox)
 
 async def poll_loop(application):
-    # Ensure polling works even if a webhook was set earlier
-    try:
-        await application.bot.delete_webhook(drop_pending_updates=False)
-        print("[INIT] delete_webhook ok")
-    except Exception as e:
-        print(f"[WARN] delete_webhook: {e}")
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
     while True:
-        class Ctx:
-            bot = application.bot
+        # sleep until the next scheduled tick, not POLL_SECONDS after the work,
+        # so slow Dexscreener responses don't push every later cycle back
+        next_tick += POLL_SECONDS
         try:
-            await poll_job(Ctx)
+            await poll_job(application.bot)
         except Exception as e:
             print(f"[WARN] poll_job: {e}")
-        await asyncio.sleep(POLL_SECONDS)
+        delay = next_tick - loop.time()
+        if delay < 0:
+            print(f"[WARN] poll overran by {-delay:.1f}s")
+            next_tick = loop.time()  # reset baseline instead of firing back-to-back
+            delay = 0
+        await asyncio.sleep(delay)
+
+def make_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=10,
+        headers=HEADERS,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+    )
+
+async def close_http():
+    if HTTP is not None:
+        await HTTP.aclose()
+        print("[HTTP] client closed")
+
+async def run(app):
+    # Drive the bot by hand rather than via run_polling(): updater.start_polling()
+    # doesn't block, so the poller runs as a peer task on the same loop.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):  # not available on Windows
+            loop.add_signal_handler(sig, stop.set)
+
+    async def startup():
+        await app.initialize()
+        await app.start()
+        # start_polling deletes any leftover webhook first (retrying until it works)
+        await app.updater.start_polling()
+
+    tasks = []
+    stopping = asyncio.create_task(stop.wait())
+    try:
+        # startup can retry forever during a Telegram outage, so race it against
+        # the stop signal instead of ignoring SIGTERM until it returns
+        starting = asyncio.create_task(startup())
+        await asyncio.wait({starting, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        if not starting.done():
+            print("[STOP] signal received during startup")
+            starting.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await starting
+            return
+        starting.result()  # re-raise a startup failure
+        print("Bot starting…")
+        tasks = [asyncio.create_task(poll_loop(app)), asyncio.create_task(persist_loop())]
+        print("Background poller started.")
+        await stopping
+    finally:
+        print("[STOP] shutting down")
+        stopping.cancel()
+        try:
+            if app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
+        finally:
+            for t in tasks:
+                t.cancel()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), SHUTDOWN_TIMEOUT)
+            try:
+                await app.shutdown()
+            finally:
+                await close_http()
 
 def main():
+    global HTTP
     if not TELEGRAM_TOKEN:
         raise SystemExit("Set TELEGRAM_BOT_TOKEN env var")
     load_state()  # load from disk on startup
 
-    app = (ApplicationBuilder().token(TELEGRAM_TOKEN).build())
+    HTTP = make_http_client()
+    app = (ApplicationBuilder().token(TELEGRAM_TOKEN).rate_limiter(AIORateLimiter(max_retries=SEND_RETRIES)).build())
 
     # handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("version", version_cmd))
-    app.add_handler(CommandHandler("ping", ping_cmd))
-    app.add_handler(CommandHandler("add", add_cmd))
-    app.add_handler(CommandHandler("remove", remove_cmd))
-    app.add_handler(CommandHandler("list", list_cmd))
-    app.add_handler(CommandHandler("clear", clear_cmd))
-
-    # background loop + polling
-    loop = asyncio.get_event_loop()
-    loop.create_task(poll_loop(app))
-    print("Bot starting…")
-    print("Background poller started.")
-    app.run_polling(close_loop=False)
+    app.add_handler(MessageHandler(filters.COMMAND & filters.UpdateType.MESSAGE, dispatch))
+
+    # polling + background loops
+    asyncio.run(run(app))
 
 if __name__ == "__main__":
     main()